@@ -1,49 +1,146 @@
+import hashlib
+import json
 import os
+import time
+import redis
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, Response, render_template, request, flash, redirect, session, g,
+    get_flashed_messages, stream_with_context, abort)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import select, insert, delete, or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, lazyload, raiseload
 from werkzeug.exceptions import Unauthorized
+from werkzeug.local import LocalProxy
 
 from forms import UserAddForm, LoginForm, MessageForm, CsrfForm, EditForm
-from models import db, connect_db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
+from models import (
+    db, connect_db, User, Message, Follow, Like,
+    DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+USERS_PAGE_LIMIT = 50
+TIMELINE_CACHE_SECONDS = 30
 
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
+# keep connections open across requests; pre-ping/recycle drop connections
+# postgres has idled out, and LIFO reuses the same few warm connections so
+# the rest can time out.
+#
+# Every gunicorn worker gets its own pool, so workers * (pool size + max
+# overflow) must fit within postgres's max_connections; gunicorn.conf.py
+# sets these from a connection budget split across its workers. Under
+# gevent, requests beyond that wait for a free connection rather than
+# opening more.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+    'pool_pre_ping': True,
+    'pool_recycle': 300,
+    'pool_use_lifo': True,
+}
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# CSRF tokens last as long as the session they're tied to, instead of an
+# hour: no timestamp to sign/check, and pages cached by ETag never carry an
+# expired token
+app.config['WTF_CSRF_TIME_LIMIT'] = None
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+# timeline caching is optional: without REDIS_URL, every homepage hit queries
+redis_client = (redis.Redis.from_url(os.environ['REDIS_URL'])
+                if 'REDIS_URL' in os.environ else None)
+
 
 ##############################################################################
 # User signup/login/logout
 
 
+def _load_user():
+    """Return the logged-in user (or None), querying at most once per request.
+
+    The result is cached on the Flask global, so only requests that actually
+    read g.user pay for the SELECT.
+    """
+
+    if '_user' not in g:
+        if CURR_USER_KEY in session:
+            # g.user is a single row, so lazy loading one of its collections
+            # costs the same one query as preloading it would -- and only
+            # pages that read it pay. The templates only read `following`
+            # (for is_following) and `liked_messages` (for like stars).
+            opts = []
+
+            # in dev/tests, any other lazy load off g.user is a bug: make it
+            # fail loudly. In production, everything just loads lazily.
+            if app.debug or app.testing:
+                opts = [
+                    lazyload(User.following),
+                    lazyload(User.liked_messages),
+                    raiseload('*'),
+                ]
+
+            g._user = db.session.get(
+                User, session[CURR_USER_KEY], options=opts)
+
+        else:
+            g._user = None
+
+    return g._user
+
+
+current_user = LocalProxy(_load_user)
+
+
+def _get_csrf_form():
+    """Return this request's CsrfForm, building it on first use.
+
+    Pages and redirects that never render or validate it skip the WTForms
+    setup (and CSRF token generation) entirely.
+    """
+
+    if '_csrf_form' not in g:
+        g._csrf_form = CsrfForm()
+
+    return g._csrf_form
+
+
+csrf_form = LocalProxy(_get_csrf_form)
+
+
 @app.before_request
 def add_user_and_csrf_to_g():
-    """If we're logged in, add curr user and csrf form to Flask global."""
+    """Add curr user and csrf form to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-        g.csrf_form = CsrfForm()
+    Both are lazy proxies: neither is built until the first time it's read.
+    """
 
-    else:
-        g.user = None
+    # connect_db pushes an app context that outlives any one request, so
+    # drop what the last request cached before proxying to it (including
+    # the CSRF token Flask-WTF caches for the last session's secret)
+    g.pop('_user', None)
+    g.pop('_csrf_form', None)
+    g.pop(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), None)
+
+    g.user = current_user
+    g.csrf_form = csrf_form
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    g.pop('_user', None)
 
 
 def do_logout():
@@ -52,6 +149,8 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    g.pop('_user', None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -75,7 +174,7 @@ def signup():
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=form.image_url.data or DEFAULT_IMAGE_URL,
             )
             db.session.commit()
 
@@ -124,6 +223,76 @@ def logout():
     return redirect("/login")
 
 
+##############################################################################
+# Conditional GETs
+#
+# Read-only pages get an ETag built from a cheap version query, so a browser
+# revalidating an unchanged page gets a 304 without us loading or rendering
+# anything.
+
+
+def page_etag(*version):
+    """Return an ETag for a page for the current user.
+
+    `version` is whatever the page's content depends on; we add what the
+    logged-in user's view of it depends on (their profile, follows and
+    likes, pending flash messages, and the session's CSRF secret and the
+    age of the token embedded from it).
+    """
+
+    time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+
+    # the page's token is only valid for this session's secret, so make sure
+    # there is one and tag it in; a fresh session never gets another's page
+    generate_csrf()
+
+    # the ids the viewer follows and likes, aggregated in the database rather
+    # than loading both collections just to hash them
+    follows, likes = db.session.execute(
+        select(
+            select(db.func.aggregate_strings(
+                db.cast(Follow.user_being_followed_id, db.String), ','))
+            .where(Follow.user_following_id == g.user.id)
+            .scalar_subquery(),
+            select(db.func.aggregate_strings(
+                db.cast(Like.message_id, db.String), ','))
+            .where(Like.user_id == g.user.id)
+            .scalar_subquery(),
+        )
+    ).one()
+
+    viewer = (
+        g.user.id,
+        g.user.username,
+        g.user.image_url,
+        g.user.header_image_url,
+        follows,
+        likes,
+        session.get('_flashes'),
+        session.get(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')),
+        # re-render before the cached page's CSRF token gets close to expiry
+        time_limit and int(time.time() // (time_limit // 2)),
+    )
+
+    return hashlib.md5(repr((viewer, version)).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Return an empty 304 response for `etag`."""
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def render_with_etag(etag, template_name, **context):
+    """Render a template, tagging the response with `etag`."""
+
+    response = app.make_response(render_template(template_name, **context))
+    response.set_etag(etag)
+    return response
+
+
 ##############################################################################
 # General user routes:
 
@@ -140,10 +309,16 @@ def list_users():
 
     search = request.args.get('q')
 
+    # cap the listing so rendering cost doesn't grow with the user table
     if not search:
-        users = User.query.all()
+        users = User.query.order_by(User.id).limit(USERS_PAGE_LIMIT).all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = (User
+                 .query
+                 .filter(User.username.ilike(f"%{search}%"))
+                 .order_by(User.username)
+                 .limit(USERS_PAGE_LIMIT)
+                 .all())
 
     return render_template('users/index.html', users=users)
 
@@ -156,9 +331,27 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    # messages can't be edited, so along with the profile fields, the
+    # message count and newest timestamp cover everything on the page
+    stats = User.get_stats(user_id)
+
+    if stats is None:
+        abort(404)
+
+    etag = page_etag(user_id, *stats)
+
+    if etag in request.if_none_match:
+        return not_modified(etag)
 
-    return render_template('users/show.html', user=user)
+    # populate_existing: the user may already be in the session (e.g. from
+    # g.user's collections) without the collection this page renders
+    user = (User
+            .query
+            .options(selectinload(User.messages))
+            .populate_existing()
+            .get_or_404(user_id))
+
+    return render_with_etag(etag, 'users/show.html', user=user, stats=stats)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -169,9 +362,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    stats = User.get_stats(user_id)
+    user = (User
+            .query
+            .options(selectinload(User.following))
+            .populate_existing()
+            .get_or_404(user_id))
 
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html', user=user, stats=stats)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -182,8 +380,14 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    stats = User.get_stats(user_id)
+    user = (User
+            .query
+            .options(selectinload(User.followers))
+            .populate_existing()
+            .get_or_404(user_id))
+
+    return render_template('users/followers.html', user=user, stats=stats)
 
 
 @app.get("/users/<int:user_id>/likes")
@@ -194,9 +398,15 @@ def show_favorite_warbles(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get(user_id)
+    stats = User.get_stats(user_id)
+    user = (User
+            .query
+            .options(
+                selectinload(User.liked_messages).selectinload(Message.user))
+            .populate_existing()
+            .get_or_404(user_id))
 
-    return render_template('users/liked_warbles.html', user=user)
+    return render_template('users/liked_warbles.html', user=user, stats=stats)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -216,10 +426,31 @@ def start_following(follow_id):
         flash("You can not follow yourself.", "danger")
         return redirect("/users")
 
-    g.user.following.append(followed_user)
-    db.session.commit()
+    # the commit expires g.user; reading g.user.id after it would reload
+    # the user just to build the url
+    user_id = g.user.id
+
+    # touch only the one follows row, rather than loading and diffing the
+    # whole g.user.following collection
+    already_following = db.session.query(
+        db.exists().where(
+            Follow.user_following_id == user_id,
+            Follow.user_being_followed_id == followed_user.id,
+        )
+    ).scalar()
+
+    if not already_following:
+        db.session.execute(
+            insert(Follow).values(
+                user_following_id=user_id,
+                user_being_followed_id=followed_user.id,
+            )
+        )
+        db.session.commit()
+
+        invalidate_timelines([user_id])
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.post('/users/stop-following/<int:follow_id>')
@@ -234,10 +465,21 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+
+    # as in start_following, don't read g.user.id after the commit
+    user_id = g.user.id
+
+    db.session.execute(
+        delete(Follow).where(
+            Follow.user_following_id == user_id,
+            Follow.user_being_followed_id == followed_user.id,
+        )
+    )
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    invalidate_timelines([user_id])
+
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -245,7 +487,6 @@ def profile():
     """Update profile for current user."""
 
     form = EditForm(obj=g.user)
-    print(form)
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -261,9 +502,12 @@ def profile():
             g.user.header_image_url = form.header_image_url.data or DEFAULT_HEADER_IMAGE_URL
             g.user.bio = form.bio.data or " "
 
+            # as in add_message, don't read g.user.id after the commit
+            user_id = g.user.id
+
             try:
                 db.session.commit()
-                return redirect(f"/users/{g.user.id}")
+                return redirect(f"/users/{user_id}")
 
             except IntegrityError:
                 db.session.rollback()
@@ -286,8 +530,12 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # cascade kicks in here so no need to delete messages separately (must have delete cascade in models though!)
-    User.query.filter_by(id=g.user.id).delete()
+    # the database's ON DELETE CASCADE removes their messages, follows and
+    # likes, so skip the ORM's in-session bookkeeping for the delete
+    db.session.execute(
+        delete(User).where(User.id == g.user.id),
+        execution_options={"synchronize_session": False},
+    )
 
     db.session.commit()
 
@@ -313,11 +561,23 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # the commit expires g.user, so take its id now rather than
+        # reloading the user afterwards just to build the url
+        user_id = g.user.id
+
+        # add by user_id, rather than appending to g.user.messages, which
+        # would load every message the user has written
+        db.session.add(Message(text=form.text.data, user_id=user_id))
+
+        follower_ids = db.session.execute(
+            select(Follow.user_following_id)
+            .where(Follow.user_being_followed_id == user_id)
+        ).scalars().all()
         db.session.commit()
 
-        return redirect(f"/users/{g.user.id}")
+        invalidate_timelines([user_id, *follower_ids])
+
+        return redirect(f"/users/{user_id}")
 
     return render_template('messages/create.html', form=form)
 
@@ -330,8 +590,30 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    # messages can't be edited, so only the author's shown fields can change
+    version = db.session.execute(
+        select(User.id, User.username, User.image_url)
+        .join(Message, Message.user_id == User.id)
+        .where(Message.id == message_id)
+    ).one_or_none()
+
+    if version is None:
+        abort(404)
+
+    etag = page_etag(message_id, *version)
+
+    if etag in request.if_none_match:
+        return not_modified(etag)
+
+    # populate_existing: as in show_user, the message may already be in the
+    # session (e.g. from g.user.messages) without its author loaded
+    msg = (Message
+           .query
+           .options(selectinload(Message.user))
+           .populate_existing()
+           .get_or_404(message_id))
+
+    return render_with_etag(etag, 'messages/show.html', message=msg)
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -351,7 +633,9 @@ def delete_message(message_id):
         db.session.delete(msg)
         db.session.commit()
 
-        return redirect(f"/users/{g.user.id}")
+        # msg.user_id survives the commit; g.user.id would reload the
+        # expired user (and its collections) just to build this url
+        return redirect(f"/users/{msg.user_id}")
 
     else:
         raise Unauthorized()
@@ -361,9 +645,6 @@ def delete_message(message_id):
 def handle_favorites(message_id):
     """handle the favoriting/unfavoriting of a function"""
 
-    # page = request.get(url)
-    # breakpoint()
-
     if not g.user or not g.csrf_form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect('/')
@@ -371,20 +652,119 @@ def handle_favorites(message_id):
     msg = Message.query.get_or_404(message_id)
     origin_url = request.form.get('origin_url')
 
-    if msg not in g.user.liked_messages:
-        g.user.liked_messages.append(msg)
-        db.session.commit()
+    # check/toggle the single likes row instead of scanning and diffing
+    # the whole g.user.liked_messages collection
+    like_filter = (Like.user_id == g.user.id, Like.message_id == msg.id)
+    is_liked = db.session.query(db.exists().where(*like_filter)).scalar()
+
+    if not is_liked:
+        db.session.execute(
+            insert(Like).values(user_id=g.user.id, message_id=msg.id))
     else:
-        g.user.liked_messages.remove(msg)
-        db.session.commit()
+        db.session.execute(delete(Like).where(*like_filter))
+
+    db.session.commit()
 
     return redirect(origin_url)
 
 
+##############################################################################
+# Timeline cache
+#
+# The homepage's timeline query gives the same answer until someone the user
+# follows posts (or they follow/unfollow someone), so we cache the ids of its
+# messages in redis for a short while and drop the cache on those events.
+# A deleted message just fails to load from its cached id, so deletes don't
+# need to invalidate anything.
+#
+# Redis errors are never fatal: we fall back to querying postgres.
+
+
+def timeline_cache_key(user_id):
+    """Return the redis key for `user_id`'s cached timeline."""
+
+    return f"tl:{user_id}"
+
+
+def get_cached_timeline(user_id):
+    """Return the cached timeline message ids for `user_id`, or None."""
+
+    if redis_client is None:
+        return None
+
+    try:
+        cached = redis_client.get(timeline_cache_key(user_id))
+    except redis.RedisError:
+        app.logger.exception("couldn't read timeline cache")
+        return None
+
+    return None if cached is None else json.loads(cached)
+
+
+def cache_timeline(user_id, message_ids):
+    """Cache `user_id`'s timeline as a list of message ids."""
+
+    if redis_client is None:
+        return
+
+    try:
+        redis_client.setex(
+            timeline_cache_key(user_id),
+            TIMELINE_CACHE_SECONDS,
+            json.dumps(message_ids),
+        )
+    except redis.RedisError:
+        app.logger.exception("couldn't write timeline cache")
+
+
+def invalidate_timelines(user_ids):
+    """Drop the cached timelines for each of `user_ids`."""
+
+    if redis_client is None:
+        return
+
+    # one round trip however many timelines we're dropping
+    pipe = redis_client.pipeline(transaction=False)
+
+    for user_id in user_ids:
+        pipe.delete(timeline_cache_key(user_id))
+
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        app.logger.exception("couldn't invalidate timeline cache")
+
+
 ##############################################################################
 # Homepage and error pages
 
 
+def stream_template_buffered(template_name, buffer_size=5, **context):
+    """Render a template as a streamed response.
+
+    Output is sent in chunks of `buffer_size` template pieces as it's
+    rendered, rather than building the whole page before the first byte.
+
+    The context has to be fully loaded already: the database session is
+    closed before streaming, so a slow client doesn't hold a pooled
+    connection (and its open transaction) until it's read every byte.
+    """
+
+    # the session cookie is written before the body streams, so do anything
+    # that changes the session now: pop any flashed messages, and create
+    # the CSRF token. The template then reads the cached copies.
+    get_flashed_messages()
+    generate_csrf()
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(buffer_size)
+
+    db.session.close()
+
+    return Response(stream_with_context(stream))
+
+
 @app.get('/')
 def homepage():
     """Show homepage:
@@ -394,25 +774,62 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following] + [g.user.id]
-
+        # selectinload batches the authors into one IN (...) query, rather
+        # than one lazy load per message rendered in the timeline
         messages = (Message
                     .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+                    .options(selectinload(Message.user))
+                    .order_by(Message.timestamp.desc()))
+        message_ids = get_cached_timeline(g.user.id)
+
+        if message_ids is not None:
+            messages = messages.filter(Message.id.in_(message_ids))
 
-        return render_template('home.html',
-                               messages=messages)
+        else:
+            # select just the followed ids as a subquery, so postgres does
+            # the semi-join itself instead of us building the id list here
+            following_ids = (select(Follow.user_being_followed_id)
+                             .where(Follow.user_following_id == g.user.id))
+
+            messages = (messages
+                        .filter(or_(Message.user_id.in_(following_ids),
+                                    Message.user_id == g.user.id))
+                        .limit(100))
+
+        messages = messages.all()
+
+        if message_ids is None:
+            cache_timeline(g.user.id, [msg.id for msg in messages])
+
+        # just which of these the user has liked, for the stars, rather than
+        # lazily loading their likes while the page streams
+        liked_ids = set(db.session.execute(
+            select(Like.message_id)
+            .where(Like.user_id == g.user.id,
+                   Like.message_id.in_([msg.id for msg in messages]))
+        ).scalars())
+
+        return stream_template_buffered('home.html',
+                                        messages=messages,
+                                        liked_ids=liked_ids,
+                                        stats=User.get_stats(g.user.id))
 
     return render_template('home-anon.html')
 
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers on every request.
+
+    Pages tagged with an ETag may be cached by the browser, but only for this
+    user and only after revalidating; everything else is never stored.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.get_etag()[0]:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.no_store = True
+
     return response
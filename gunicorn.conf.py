@@ -0,0 +1,41 @@
+"""Gunicorn config for Warbler.
+
+Every route is I/O bound (postgres, then render), so we run gevent workers:
+each worker can have many requests waiting on the database at once.
+
+Run with:
+
+    gunicorn app:app
+"""
+
+import multiprocessing
+import os
+
+worker_class = "gevent"
+
+# Each worker gets its own connection pool (DB_POOL_SIZE plus
+# DB_MAX_OVERFLOW, see app.py), so the workers split DB_MAX_CONNECTIONS
+# between them: by default, postgres's 100 less some for psql, migrations
+# and superusers.
+db_max_connections = int(os.environ.get("DB_MAX_CONNECTIONS", 90))
+
+# gevent workers each handle many requests at once, so we want about one
+# per core (not the sync-worker 2 * cores + 1), but no more than there are
+# connections to go round.
+workers = int(os.environ.get(
+    "WEB_CONCURRENCY", min(multiprocessing.cpu_count(), db_max_connections)))
+worker_connections = 1000
+
+# Each worker gets at most the 10 connections app.py defaults to; pool
+# settings already in the environment win. (Set WEB_CONCURRENCY rather
+# than passing -w, so this sees the real worker count.)
+db_connections = min(10, max(1, db_max_connections // workers))
+os.environ.setdefault("DB_POOL_SIZE", str((db_connections + 1) // 2))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(db_connections // 2))
+
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to other greenlets while waiting on postgres."""
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -88,9 +88,23 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    __table_args__ = (
+        # trigram index lets the `%search%` username lookup in list_users
+        # use an index instead of a full table scan (postgres only; the
+        # pg_trgm extension is created just before the table, below)
+        db.Index(
+            'users_username_trgm',
+            username,
+            postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+        ).ddl_if(dialect='postgresql'),
+    )
+
+    messages = db.relationship('Message', backref="user", passive_deletes=True)
     # backref lets us do user.messages (list of messages) AND message.user
     # no secondary = no thru table
+    # passive_deletes: leave deleting a user's messages to the database's
+    # ON DELETE CASCADE, rather than loading them first
 
     followers = db.relationship(
         "User",
@@ -149,6 +163,48 @@ class User(db.Model):
 
         return False
 
+    @classmethod
+    def get_stats(cls, user_id):
+        """Return the profile fields and counts the user pages show.
+
+        Counts come straight from the database, so the pages don't have to
+        load whole collections just to take their length. Returns None if
+        there's no such user.
+        """
+
+        return db.session.execute(
+            db.select(
+                cls.username,
+                cls.image_url,
+                cls.header_image_url,
+                cls.bio,
+                cls.location,
+                db.select(db.func.count(Message.id))
+                .where(Message.user_id == cls.id)
+                .scalar_subquery()
+                .label('message_count'),
+                db.select(db.func.max(Message.timestamp))
+                .where(Message.user_id == cls.id)
+                .scalar_subquery()
+                .label('last_message_at'),
+                db.select(db.func.count())
+                .select_from(Follow)
+                .where(Follow.user_being_followed_id == cls.id)
+                .scalar_subquery()
+                .label('follower_count'),
+                db.select(db.func.count())
+                .select_from(Follow)
+                .where(Follow.user_following_id == cls.id)
+                .scalar_subquery()
+                .label('following_count'),
+                db.select(db.func.count())
+                .select_from(Like)
+                .where(Like.user_id == cls.id)
+                .scalar_subquery()
+                .label('like_count'),
+            ).where(cls.id == user_id)
+        ).one_or_none()
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -164,6 +220,14 @@ class User(db.Model):
         return len(found_user_list) == 1
 
 
+db.event.listen(
+    User.__table__,
+    'before_create',
+    db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -192,6 +256,11 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        # timeline query filters on user_id and orders by newest first
+        db.Index('ix_messages_user_id_timestamp', user_id, timestamp.desc()),
+    )
+
 
 class Like(db.Model):
     """Like model"""
@@ -222,3 +291,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
@@ -0,0 +1,61 @@
+"""Shared setup for the model and view tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, bcrypt
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+
+# bcrypt's cost is exponential in its rounds; the minimum (4) keeps hashing
+# in tests fast, and one precomputed hash serves every fixture user
+
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+bcrypt.init_app(app)
+
+PASSWORD_HASH = bcrypt.generate_password_hash("password").decode('UTF-8')
+
+
+def setUpModule():
+    """Create our tables once for all tests in a module.
+
+    Each test runs inside a transaction that's rolled back afterwards, so
+    there's no need to delete data or rebuild the tables between tests.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+
+class DatabaseTestCase(TestCase):
+    """Runs each test inside one outer transaction that's rolled back.
+
+    Subclasses add their fixtures after calling super().setUp().
+    """
+
+    def setUp(self):
+        # run the whole test (including the app's own commits) inside one
+        # outer transaction; commits only release savepoints within it
+        self.connection = db.engine.connect()
+        self.trans = self.connection.begin()
+        self.app_session = db.session
+        db.session = scoped_session(sessionmaker(
+            bind=self.connection,
+            join_transaction_mode="create_savepoint",
+        ))
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self.app_session
+        self.trans.rollback()
+        self.connection.close()
@@ -5,21 +5,18 @@
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 
 
-from app import app, CURR_USER_KEY
-import os
+import json
+from contextlib import contextmanager
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
+import redis
+from sqlalchemy import delete, event, insert
 
+from test_helpers import (  # noqa: F401
+    DatabaseTestCase, PASSWORD_HASH, setUpModule)
+from app import app, CURR_USER_KEY
+from models import db, Message, User, Like, Follow
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -27,31 +24,51 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageBaseViewTestCase(TestCase):
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside the with block.
+
+    Lets tests cap how many queries a page makes, so an N+1 regression
+    shows up as a failing test.
+    """
+
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        # savepoints come from our per-test transaction, not from the app
+        if not statement.startswith(("SAVEPOINT", "RELEASE", "ROLLBACK")):
+            queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(
+            db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class MessageBaseViewTestCase(DatabaseTestCase):
     def setUp(self):
-        User.query.delete()
+        super().setUp()
 
-        u1 = User.signup("u1", "u1@email.com", "password", None)
-        db.session.flush()
+        self.u1_id = db.session.execute(
+            insert(User).returning(User.id),
+            [{"username": "u1",
+              "email": "u1@email.com",
+              "password": PASSWORD_HASH}],
+        ).scalar_one()
 
-        m1 = Message(text="m1-text", user_id=u1.id)
-        db.session.add_all([m1])
-        db.session.commit()
+        self.m1_id = db.session.execute(
+            insert(Message).returning(Message.id),
+            [{"text": "m1-text", "user_id": self.u1_id}],
+        ).scalar_one()
 
-        self.u1_id = u1.id
-        self.m1_id = m1.id
+        db.session.commit()
 
 
 class MessageAddViewTestCase(MessageBaseViewTestCase):
@@ -78,13 +95,187 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            resp = c.post(
-                f"/messages/{self.m1_id}/delete", follow_redirects=True)
+            # start from an empty identity map so objects left over from
+            # setUp don't hide queries the view really makes
+            db.session.expunge_all()
+
+            with count_queries() as queries:
+                resp = c.post(f"/messages/{self.m1_id}/delete")
+
+            # message, current user, delete
+            self.assertLessEqual(len(queries), 3)
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get(resp.location)
             u1 = User.query.get(self.u1_id)
 
             self.assertEqual(len(u1.messages), 0)
             self.assertEqual(resp.status_code, 200)
 
+    def test_homepage_query_count(self):
+        """ homepage timeline runs a fixed number of queries, however many
+        messages it shows """
+
+        # messages from several followed users, so loading each author
+        # separately (an N+1) would show up in the count
+        author_ids = db.session.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [
+                {"username": f"author{i}",
+                 "email": f"author{i}@email.com",
+                 "password": PASSWORD_HASH}
+                for i in range(3)
+            ],
+        ).scalars().all()
+
+        db.session.execute(
+            insert(Message),
+            [{"text": f"author-text-{i}", "user_id": author_id}
+             for i, author_id in enumerate(author_ids)],
+        )
+        db.session.execute(
+            insert(Follow),
+            [{"user_following_id": self.u1_id,
+              "user_being_followed_id": author_id}
+             for author_id in author_ids],
+        )
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # start from an empty identity map so objects left over from
+            # setUp don't hide queries the view really makes
+            db.session.expunge_all()
+
+            # the page is streamed, so read the body inside the block to
+            # count queries the template makes while rendering too
+            with count_queries() as queries:
+                resp = c.get("/")
+                html = resp.get_data(as_text=True)
+
+            # current user, profile stats, messages, message authors (all
+            # in one go), current user's likes
+            self.assertLessEqual(len(queries), 5)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m1-text", html)
+
+            for i in range(3):
+                self.assertIn(f"author-text-{i}", html)
+
+    def test_write_routes_query_count(self):
+        """ POST handlers that only need the current user's id don't load
+        any of the user's collections """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            db.session.expunge_all()
+
+            with count_queries() as queries:
+                c.post(f"/message/{self.m1_id}/favorite",
+                       data={"origin_url": "/"})
+
+            # current user, message, like exists?, like insert
+            self.assertLessEqual(len(queries), 4)
+
+            db.session.expunge_all()
+
+            with count_queries() as queries:
+                c.post("/messages/new", data={"text": "Hello"})
+
+            # current user, follower ids, message insert
+            self.assertLessEqual(len(queries), 3)
+
+    def test_favorite_toggles_like(self):
+        """ favoriting a message adds the likes row; favoriting it again
+        removes it """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            def likes():
+                return db.session.execute(
+                    db.select(Like.message_id)
+                    .where(Like.user_id == self.u1_id)
+                ).scalars().all()
+
+            resp = c.post(f"/message/{self.m1_id}/favorite",
+                          data={"origin_url": "/"})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(likes(), [self.m1_id])
+
+            c.post(f"/message/{self.m1_id}/favorite",
+                   data={"origin_url": "/"})
+
+            self.assertEqual(likes(), [])
+
+    def test_show_message_not_modified(self):
+        """ re-requesting an unchanged message page with its ETag gets a 304,
+        and liking the message changes the ETag """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            etag = resp.get_etag()[0]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.private)
+
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": f'"{etag}"'})
+
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/message/{self.m1_id}/favorite",
+                   data={"origin_url": "/"})
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": f'"{etag}"'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.get_etag()[0], etag)
+
+    def test_show_message_etag_is_per_session(self):
+        """ another session for the same user doesn't get a 304 for a page
+        whose CSRF tokens are only valid in the first session """
+
+        with patch.dict(app.config, {"WTF_CSRF_ENABLED": True}):
+            c1 = app.test_client()
+            c2 = app.test_client()
+            for c in (c1, c2):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+            etag = c1.get(f"/messages/{self.m1_id}").get_etag()[0]
+
+            resp = c1.get(f"/messages/{self.m1_id}",
+                          headers={"If-None-Match": f'"{etag}"'})
+
+            self.assertEqual(resp.status_code, 304)
+
+            resp = c2.get(f"/messages/{self.m1_id}",
+                          headers={"If-None-Match": f'"{etag}"'})
+
+            self.assertEqual(resp.status_code, 200)
+
+            # and the page c2 did get carries a token its session accepts
+            html = resp.get_data(as_text=True)
+            token = html.split('name="csrf_token" type="hidden" value="')[1]
+            resp = c2.post(f"/message/{self.m1_id}/favorite",
+                           data={"origin_url": "/",
+                                 "csrf_token": token.split('"')[0]})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                db.session.execute(db.select(Like.message_id)).scalars().all(),
+                [self.m1_id])
+
     # def test_add_message_logged_out(self):
     #     """ when logged out, test that user is prohibited from adding
     #     a message """
@@ -107,3 +298,202 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
     #         self.assertEqual(len(u1.messages), 0)
     #         self.assertEqual(resp.status_code, 200)
+
+
+class FakeRedis:
+    """Just enough of a redis client, in memory, for the timeline cache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, seconds, value):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        # deletes apply straight away; execute() has nothing left to do
+        return self
+
+    def execute(self):
+        return []
+
+
+class BrokenRedis:
+    """A redis client whose server is down."""
+
+    def get(self, key):
+        raise redis.ConnectionError()
+
+    def setex(self, key, seconds, value):
+        raise redis.ConnectionError()
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def delete(self, *keys):
+        pass
+
+    def execute(self):
+        raise redis.ConnectionError()
+
+
+class TimelineCacheTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.u2_id = db.session.execute(
+            insert(User).returning(User.id),
+            [{"username": "u2",
+              "email": "u2@email.com",
+              "password": PASSWORD_HASH}],
+        ).scalar_one()
+        db.session.commit()
+
+        self.redis = FakeRedis()
+        patcher = patch("app.redis_client", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def client_for(self, user_id):
+        """Return a test client logged in as `user_id`."""
+
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return c
+
+    def test_homepage_caches_timeline(self):
+        """ a cache miss stores the timeline's message ids """
+
+        resp = self.client_for(self.u1_id).get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(self.redis.get(f"tl:{self.u1_id}")), [self.m1_id])
+
+    def test_homepage_serves_cached_timeline(self):
+        """ a cache hit shows the cached messages, and not ones the timeline
+        query would find """
+
+        self.redis.setex(f"tl:{self.u1_id}", 30, json.dumps([]))
+
+        html = self.client_for(self.u1_id).get("/").get_data(as_text=True)
+
+        self.assertNotIn("m1-text", html)
+
+    def test_followed_user_post_invalidates(self):
+        """ posting a message drops the cached timelines of the author and
+        their followers """
+
+        db.session.execute(insert(Follow).values(
+            user_following_id=self.u1_id, user_being_followed_id=self.u2_id))
+        db.session.commit()
+
+        u1_client = self.client_for(self.u1_id)
+        u1_client.get("/")
+        self.client_for(self.u2_id).post(
+            "/messages/new", data={"text": "u2-text"})
+
+        self.assertIsNone(self.redis.get(f"tl:{self.u1_id}"))
+        self.assertIsNone(self.redis.get(f"tl:{self.u2_id}"))
+        self.assertIn("u2-text", u1_client.get("/").get_data(as_text=True))
+
+    def test_follow_and_unfollow_invalidate(self):
+        """ following or unfollowing drops the follower's cached timeline """
+
+        c = self.client_for(self.u1_id)
+
+        c.get("/")
+        c.post(f"/users/follow/{self.u2_id}")
+
+        self.assertIsNone(self.redis.get(f"tl:{self.u1_id}"))
+
+        c.get("/")
+        c.post(f"/users/stop-following/{self.u2_id}")
+
+        self.assertIsNone(self.redis.get(f"tl:{self.u1_id}"))
+
+    def test_redis_errors_fall_back_to_postgres(self):
+        """ with redis down, the homepage still queries its timeline and
+        posting a message still works """
+
+        with (patch("app.redis_client", BrokenRedis()),
+              self.assertLogs(app.logger, "ERROR")):
+            c = self.client_for(self.u1_id)
+
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+
+            resp = c.post("/messages/new", data={"text": "Hello"})
+
+            self.assertEqual(resp.status_code, 302)
+            Message.query.filter_by(text="Hello").one()
+
+
+class HomepageStreamTestCase(TestCase):
+    """Runs against the app's own session, not DatabaseTestCase's shared
+    connection, so the pool shows whether the request still holds one.
+    Fixtures are really committed, and deleted again afterwards."""
+
+    def setUp(self):
+        self.u1_id, self.u2_id = db.session.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [
+                {"username": f"u{i}",
+                 "email": f"u{i}@email.com",
+                 "password": PASSWORD_HASH}
+                for i in (1, 2)
+            ],
+        ).scalars().all()
+
+        self.m1_id = db.session.execute(
+            insert(Message).returning(Message.id),
+            [{"text": "m1-text", "user_id": self.u2_id}],
+        ).scalar_one()
+
+        db.session.execute(
+            insert(Follow),
+            [{"user_following_id": self.u1_id,
+              "user_being_followed_id": self.u2_id}],
+        )
+        db.session.execute(
+            insert(Like), [{"user_id": self.u1_id, "message_id": self.m1_id}])
+        db.session.commit()
+        db.session.remove()
+
+        patcher = patch("app.redis_client", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        db.session.remove()
+        for model in (Like, Follow, Message, User):
+            db.session.execute(delete(model))
+        db.session.commit()
+        db.session.remove()
+
+    def test_homepage_releases_connection_before_streaming(self):
+        """ the streamed homepage gives its connection back to the pool
+        before the body is read, and still renders the user's likes """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+
+            self.assertEqual(db.engine.pool.checkedout(), 0)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertIn("bi-star-fill", html)
@@ -5,44 +5,29 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
-
-from models import db, User, Message, Follow
+from sqlalchemy import insert
 from sqlalchemy.exc import IntegrityError
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
+from test_helpers import (  # noqa: F401
+    DatabaseTestCase, PASSWORD_HASH, setUpModule)
+from models import db, User, Message, Follow
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     def setUp(self):
-        User.query.delete()
-
-        u1 = User.signup("u1", "u1@email.com", "password", None)
-        u2 = User.signup("u2", "u2@email.com", "password", None)
+        super().setUp()
+
+        self.u1_id, self.u2_id = db.session.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [
+                {"username": f"u{i}",
+                 "email": f"u{i}@email.com",
+                 "password": PASSWORD_HASH}
+                for i in (1, 2)
+            ],
+        ).scalars().all()
 
         db.session.commit()
-        self.u1_id = u1.id
-        self.u2_id = u2.id
-
-    def tearDown(self):
-        db.session.rollback()
 
     def test_user_model(self):
         u1 = User.query.get(self.u1_id)
@@ -87,6 +72,24 @@ class UserModelTestCase(TestCase):
         self.assertFalse(u1.is_followed_by(u2))
         self.assertEqual(len(u1.followers), 0)
 
+    def test_get_stats(self):
+        """counts on the stats row match the user's messages and follows"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.followers.append(u2)
+        u1.messages.append(Message(text="hello"))
+        db.session.commit()
+
+        stats = User.get_stats(self.u1_id)
+
+        self.assertEqual(stats.username, "u1")
+        self.assertEqual(stats.message_count, 1)
+        self.assertEqual(stats.follower_count, 1)
+        self.assertEqual(stats.following_count, 0)
+        self.assertEqual(stats.like_count, 0)
+        self.assertIsNone(User.get_stats(0))
+
     def test_user_signup_success(self):
         """successfully create a new user given valid credentials"""
 
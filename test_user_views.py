@@ -0,0 +1,91 @@
+"""User View tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_user_views.py
+
+
+from sqlalchemy import insert
+
+from test_helpers import (  # noqa: F401
+    DatabaseTestCase, PASSWORD_HASH, setUpModule)
+from app import app, CURR_USER_KEY
+from models import db, User, Follow
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UserBaseViewTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.u1_id, self.u2_id = db.session.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [
+                {"username": f"u{i}",
+                 "email": f"u{i}@email.com",
+                 "password": PASSWORD_HASH}
+                for i in (1, 2)
+            ],
+        ).scalars().all()
+
+        db.session.commit()
+
+    def follows_from_u1(self):
+        """Return the ids of the users u1 follows."""
+
+        return db.session.execute(
+            db.select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == self.u1_id)
+        ).scalars().all()
+
+
+class UserFollowViewTestCase(UserBaseViewTestCase):
+    def test_start_following(self):
+        """ following a user adds the follows row and redirects to the
+        current user's following page """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/users/follow/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, f"/users/{self.u1_id}/following")
+            self.assertEqual(self.follows_from_u1(), [self.u2_id])
+
+    def test_start_following_already_following(self):
+        """ following a user you already follow is a no-op """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            resp = c.post(f"/users/follow/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.follows_from_u1(), [self.u2_id])
+
+    def test_stop_following(self):
+        """ unfollowing a user removes the follows row """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            resp = c.post(f"/users/stop-following/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, f"/users/{self.u1_id}/following")
+            self.assertEqual(self.follows_from_u1(), [])